@@ -1,12 +1,57 @@
-import boto3
+import botocore.session
 import logging
 import time
 import datetime
 import ast
+import json
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from zoneinfo import ZoneInfo
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+MAX_INSTANCE_IDS_PER_CALL = 1000
+MAX_ACCOUNT_WORKERS = 8
+CONFIG_CACHE_TTL = 300
+CREDENTIALS_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+TIMEZONE = ZoneInfo('Europe/London')
+# botocore's default pool of 10 connections already covers the account workers sharing the STS client.
+CLIENT_CONFIG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown')
+
+ACTION_REQUIRED = 'action_required'
+NO_ACTION_REQUIRED = 'no_action_required'
+UNTAGGED = 'untagged'
+
+# Kept at module level so warm Lambda invocations can reuse them.
+_SESSION = botocore.session.get_session()
+_CONFIG_CACHE = {'value': None, 'fetched_at': 0}
+_STS_CLIENT = None
+_EC2_CLIENTS = {}
+_TIME_CACHE = {}
+
+# Creating boto clients concurrently is not thread-safe, unlike using them.
+_CLIENT_LOCK = threading.Lock()
+
+def is_throttling_error(error):
+    """
+    Check whether a boto ClientError was caused by API throttling.
+    :param error: A botocore.exceptions.ClientError
+    :return True/False: Depending on the error code of the response
+    """
+    return error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+def chunk_instance_ids(instance_ids):
+    """
+    Split the instance ids into slices that fit in a single StartInstances/StopInstances call.
+    :param instance_ids: A list of instances ids.
+    :return: A list of lists with at most MAX_INSTANCE_IDS_PER_CALL instance ids each
+    """
+    return [instance_ids[i:i + MAX_INSTANCE_IDS_PER_CALL] for i in range(0, len(instance_ids), MAX_INSTANCE_IDS_PER_CALL)]
 
 def action_on_instances(client_method, instance_ids, action):
     """
@@ -15,19 +60,25 @@ def action_on_instances(client_method, instance_ids, action):
     :param instance_ids: A list of instances ids.
     :param action: A string with the action. Mostly for logging reasons.
     """
-    try:
-        if instance_ids:
-            logger.info('{}ing the following instances'.format(action))
-            logger.info(instance_ids)
-            client_method(InstanceIds=instance_ids)
+    if instance_ids:
+        logger.info('{}ing the following instances'.format(action))
+        logger.info(instance_ids)
+        succeeded = True
+        for chunk in chunk_instance_ids(instance_ids):
+            try:
+                client_method(InstanceIds=chunk)
+            except ClientError as error:
+                logger.error('{} failed for {} with the following output : {}'.format(action, chunk, error))
+                if not is_throttling_error(error):
+                    raise
+                succeeded = False
+        if succeeded:
             logger.info('{} has finished successfully'.format(action))
-        else:
-            logger.info('No action was taken because one of the following:')
-            logger.info('1 - Instances have "NoShutdown" flag.')
-            logger.info('2 - Instances do not have "Schedule" tag.')
-            logger.info('3 - Instances have no value in "Schedule" tag.')
-    except Exception as error:
-        logger.error('{} failed with the following output : {}'.format(action, error))
+    else:
+        logger.info('No action was taken because one of the following:')
+        logger.info('1 - Instances have "NoShutdown" flag.')
+        logger.info('2 - Instances do not have "Schedule" tag.')
+        logger.info('3 - Instances have no value in "Schedule" tag.')
 
 def stop_untagged_instances(untagged_instance_ids, temporary_user):
     """
@@ -35,12 +86,58 @@ def stop_untagged_instances(untagged_instance_ids, temporary_user):
     :param untagged_instance_ids: A list of all the untagged instances.
     :param temporary_user: The boto user that will be used to stop the untagged instances
     """
-    try:
-        logger.info('Stopping the untagged instances : ')
-        logger.info(untagged_instance_ids)
-        temporary_user.stop_instances(InstanceIds=untagged_instance_ids)
-    except Exception as error:
-        logger.info('The instances failed to stop with the following error : {}'.format(error))
+    logger.info('Stopping the untagged instances : ')
+    logger.info(untagged_instance_ids)
+    for chunk in chunk_instance_ids(untagged_instance_ids):
+        try:
+            temporary_user.stop_instances(InstanceIds=chunk)
+        except ClientError as error:
+            logger.error('The instances {} failed to stop with the following error : {}'.format(chunk, error))
+            if not is_throttling_error(error):
+                raise
+
+def schedule_decisions(config):
+    """
+    Build a lookup table from the value of the Schedule tag to the category of the instance.
+    :param config: A disctionary with the values for `allDay` and `halfDay`
+    :return: A dictionary mapping Schedule tag values to ACTION_REQUIRED or NO_ACTION_REQUIRED
+    """
+    # Later keys win, so an empty or `allDay` value takes precedence over `halfDay` if they coincide.
+    return {
+        config['schedule']['halfDay']: ACTION_REQUIRED,
+        config['schedule']['allDay']: NO_ACTION_REQUIRED,
+        '': NO_ACTION_REQUIRED
+    }
+
+def category_of(instance, decisions, stop_untagged):
+    """
+    Decide what should happen to a single instance based on its tags.
+    :param instance: A dictionary describing the instance
+    :param decisions: The lookup table built by schedule_decisions()
+    :param stop_untagged: Whether instances without `Schedule`/`NoShutdown` tags should be stopped
+    :return: One of ACTION_REQUIRED, NO_ACTION_REQUIRED, UNTAGGED or None if the instance should be ignored
+    """
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+    if 'NoShutdown' in tags:
+        return NO_ACTION_REQUIRED
+    if 'Schedule' in tags:
+        return decisions.get(tags['Schedule'])
+    if stop_untagged:
+        return UNTAGGED
+    return None
+
+def classify(data, config):
+    """
+    Yield the category and id of every instance in the describe_instances response.
+    :param data: A disctionary with information about the instances
+    :param config: A disctionary with the values for `allDay` and `halfDay`
+    :return: A generator of (category, instance_id) tuples
+    """
+    decisions = schedule_decisions(config)
+    stop_untagged = 'True' in config['stop_untagged_instances']
+    for reservation in data['Reservations']:
+        for instance in reservation['Instances']:
+            yield category_of(instance, decisions, stop_untagged), instance['InstanceId']
 
 def categorise_instances(data, config, temporary_user):
     """
@@ -51,34 +148,14 @@ def categorise_instances(data, config, temporary_user):
     :return action_required: List of instance ids that have to be either stopped or started
     :return no_action_required: List of instance ids that should not be tempered with (`NoShutdown` tag or Schedule tag with [`allDay`] value is applied to these instances)
     """
-    try:
-        if data:
-            action_required = []
-            no_action_required = []
-            untagged_instances = []
-            for reservation in data['Reservations']:
-                tag_list = []
-                for instance in reservation['Instances']:
-                    for tag in instance['Tags']:
-                        tag_list.append(tag['Key'])
-                    if 'NoShutdown' in tag_list:
-                        no_action_required.append(reservation['Instances'][0]['InstanceId'])
-                    elif 'Schedule' in tag_list:
-                        for tag in instance['Tags']:
-                            if 'Schedule' in tag['Key']:
-                                if tag['Value'] == '':
-                                    no_action_required.append(reservation['Instances'][0]['InstanceId'])
-                                elif tag['Value'] == config['schedule']['allDay']:
-                                    no_action_required.append(reservation['Instances'][0]['InstanceId'])
-                                elif tag['Value'] == config['schedule']['halfDay']:
-                                    action_required.append(reservation['Instances'][0]['InstanceId'])
-                    else:
-                        if 'True' in config['stop_untagged_instances']:
-                            untagged_instances.append(instance['InstanceId'])
-                            stop_untagged_instances(untagged_instances, temporary_user)
-            return action_required, no_action_required
-    except Exception as error:
-        logger.info("Categorisation of instances according to tags failed with this error : {}".format(error))
+    if not data:
+        return [], []
+    buckets = defaultdict(list)
+    for category, instance_id in classify(data, config):
+        buckets[category].append(instance_id)
+    if buckets[UNTAGGED]:
+        stop_untagged_instances(buckets[UNTAGGED], temporary_user)
+    return buckets[ACTION_REQUIRED], buckets[NO_ACTION_REQUIRED]
 
 
 
@@ -93,13 +170,21 @@ def get_instance_ids(temporary_user, config, state, now, tz):
     :return no_action_required: List of instance ids that should not be tempered with (`NoShutdown` tag or Schedule tag with [`allDay`] value is applied to these instances)
     """
     try:
-        data = temporary_user.describe_instances(Filters=[{'Name':'instance-state-name', 'Values': [state]}])
-        logger.info("The date is : {} , {}".format(now.strftime("%A, %d %B %Y %H:%M:%S"), tz))
+        filters = [{'Name':'instance-state-name', 'Values': [state]}]
+        if state == 'stopped' or 'True' not in config['stop_untagged_instances']:
+            # Untagged instances are only needed when running ones have to be stopped, otherwise let EC2 drop them.
+            filters.append({'Name':'tag-key', 'Values': ['Schedule', 'NoShutdown']})
+        paginator = temporary_user.get_paginator('describe_instances')
+        data = paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}).build_full_result()
+    except ClientError as error:
+        logger.error("Describing the instances failed with the following error : {}".format(error))
+        if not is_throttling_error(error):
+            raise
+        return [], []
+    logger.info("The date is : {} , {}".format(now.strftime("%A, %d %B %Y %H:%M:%S"), tz))
 
-        action_required, no_action_required = categorise_instances(data, config, temporary_user)
-        return action_required, no_action_required
-    except Exception as error:
-        logger.info("Describing the instances failed with the following error : {}".format(error))
+    action_required, no_action_required = categorise_instances(data, config, temporary_user)
+    return action_required, no_action_required
 
 def start_stop(now, start, stop, temporary_user, config, tz):
     """
@@ -112,64 +197,88 @@ def start_stop(now, start, stop, temporary_user, config, tz):
     :param config: A disctionary with the configuration values that needs to be passed to get_instance_ids() method.
     :tz: Timezone of the server running the lambda
     """
-    if now.time() >= start and now.time() < stop:
+    if in_start_window(now, start, stop):
         action_required_ids, no_action_required_ids = get_instance_ids(temporary_user, config, 'stopped', now, tz)
         action_on_instances(temporary_user.start_instances, action_required_ids, 'Start')
-    elif now.time() >= stop:
+    elif in_stop_window(now, stop):
         action_required_ids, no_action_required_ids = get_instance_ids(temporary_user, config, 'running', now, tz)
         action_on_instances(temporary_user.stop_instances, action_required_ids, 'Stop')
 
-def convert_to_datetime(config):
+def in_start_window(now, start, stop):
+    """
+    Check whether the instances should be started at the current time.
+    :param now: The current time.
+    :param start: The time when the instances should be started.
+    :param stop: The time when the instances should be stopped.
+    :return True/False: True between the start and the stop time.
+    """
+    return start <= now.time() < stop
+
+def in_stop_window(now, stop):
+    """
+    Check whether the instances should be stopped at the current time.
+    :param now: The current time.
+    :param stop: The time when the instances should be stopped.
+    :return True/False: True from the stop time until midnight.
+    """
+    return now.time() >= stop
+
+def has_action(now, start, stop):
+    """
+    Check whether start_stop() would start or stop anything at the current time.
+    :param now: The current time.
+    :param start: The time when the instances should be started.
+    :param stop: The time when the instances should be stopped.
+    :return True/False: False when the current time falls in neither the start nor the stop window.
+    """
+    return in_start_window(now, start, stop) or in_stop_window(now, stop)
+
+def parse_time(value):
+    """
+    Convert a `hour,minute` config value to a datetime.time() object. Parsed values are cached.
+    :param value: A string like `7,30`
+    :return: A datetime.time() object
+    """
+    if value not in _TIME_CACHE:
+        hour, minute = value.split(',')
+        _TIME_CACHE[value] = datetime.time(int(hour), int(minute))
+    return _TIME_CACHE[value]
+
+def convert_to_datetime(config, now):
     """
     Convert the config values for the start/stop time of the instances to datetime.time() object so they can be comparable.
     :param config: A disctionary with the values for `startTime` and `stopTime`
+    :param now: The current time, as a timezone aware datetime.datetime() object
     :return start_up_time: A time object for when the instances should start. It it of datetime.time() object
     :return stop_time: A time object for when the instances should stop. It it of datetime.time() object
-    :return now: A datetime object for the current date. It it of datetime.datetime() object
     :tz: The current timezone
     """
     try:
-        current_time = datetime.datetime.now()
-        now, tz = is_dst(datetime.datetime.now())
-        startTimeHour, startTimeMinute = config['startTime'].split(',')
-        stopTimeHour, stopTimeMinute = config['stopTime'].split(',')
-        start_up_time = datetime.time(int(startTimeHour), int(startTimeMinute))
-        stop_time = datetime.time(int(stopTimeHour), int(stopTimeMinute))
-        return start_up_time, stop_time, now, tz
+        tz = now.tzname()
+        start_up_time = parse_time(config['startTime'])
+        stop_time = parse_time(config['stopTime'])
+        return start_up_time, stop_time, tz
     except Exception as error:
         logger.info("Converting config values to time objects failed with the following error : {}".format(error))
 
-def is_dst(now):
-    """
-    Checks out if the current time and date is on DST. If is it on DST 1 hour is added to the current time.
-    :param now: The current time
-    :return now: The currnent time as datetime.datetime() object
-    :return tz: The timezone of the current time and date
-    """
-    dst_start_date = datetime.datetime(now.year, 4, 1)
-    dst_end_date = datetime.datetime(now.year, 11, 1)
-    dston = dst_start_date - datetime.timedelta(days=dst_start_date.weekday() + 1)
-    dstoff = dst_end_date - datetime.timedelta(days=dst_end_date.weekday() + 1)
-
-    if dston <= now.replace(tzinfo=None) < dstoff:
-        tz = "GMT +1"
-        return now + datetime.timedelta(hours=1), tz
-    else:
-        tz = "GMT"
-        return now, tz
-
 def json_to_dict(s3_user):
     """
     Read the config the S3 Bucket (a json file), and convert it into a dictionary.
     :param s3_user: A boto user that will make the call to read the file.
-    :return ast.literal_eval(s3_config): The content of the json file converted to dictionary
+    :return json.loads(s3_config): The content of the json file converted to dictionary
     """
     try:
-        s3_config = s3_user.get_object(Bucket="hermes-sharedservices-data", Key="Lambdas/start-stop/config.json")['Body'].read()
+        s3_config = s3_user.get_object(Bucket="hermes-sharedservices-data", Key="Lambdas/start-stop/config.json")['Body'].read().decode('utf-8')
         logger.info('Fetching config file..')
-        return ast.literal_eval(s3_config)
-    except Exception as error:
+        try:
+            return json.loads(s3_config)
+        except json.JSONDecodeError:
+            # Older config files were written as Python literals.
+            return ast.literal_eval(s3_config)
+    except ClientError as error:
         logger.info("Reading the config from S3 failed with the following error : {}".format(error))
+        if not is_throttling_error(error):
+            raise
 
 def create_temp_user(client, role_arn):
     """
@@ -179,19 +288,30 @@ def create_temp_user(client, role_arn):
     :return ec2_user: A boto user to make the appropriate calls.
     """
     try:
+        cached = _EC2_CLIENTS.get(role_arn)
+        if cached and datetime.datetime.now(datetime.timezone.utc) < cached['expires_at']:
+            return cached['client']
         response = client.assume_role(
             RoleArn=role_arn,
             RoleSessionName="Lambda-Start-Stop-functionality"
         )
-        ec2_user = boto3.client(
-            'ec2',
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
+        with _CLIENT_LOCK:
+            ec2_user = _SESSION.create_client(
+                'ec2',
+                aws_access_key_id=response['Credentials']['AccessKeyId'],
+                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
+                aws_session_token=response['Credentials']['SessionToken'],
+                config=CLIENT_CONFIG
+            )
+        _EC2_CLIENTS[role_arn] = {
+            'client': ec2_user,
+            'expires_at': response['Credentials']['Expiration'] - CREDENTIALS_EXPIRY_MARGIN
+        }
         return ec2_user
-    except Exception as error:
+    except ClientError as error:
         logger.info("Creating a temporary ec2 privileged user failed with the following error : {}".format(error))
+        if not is_throttling_error(error):
+            raise
 
 def is_weekday(day, halfDay):
     """
@@ -219,49 +339,109 @@ def fetch_config_from_s3(client):
             RoleArn="arn:aws:iam::548760365095:role/Ec2StartStopLambdaActionRole",
             RoleSessionName="Ec2-Start-Stop-Lambda-Session-Role"
         )
-        fetcher = boto3.client(
-            's3',
-            aws_access_key_id=response['Credentials']['AccessKeyId'],
-            aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-            aws_session_token=response['Credentials']['SessionToken']
-        )
-        return json_to_dict(fetcher)
-    except Exception as error:
+        with _CLIENT_LOCK:
+            fetcher = _SESSION.create_client(
+                's3',
+                aws_access_key_id=response['Credentials']['AccessKeyId'],
+                aws_secret_access_key=response['Credentials']['SecretAccessKey'],
+                aws_session_token=response['Credentials']['SessionToken'],
+                config=CLIENT_CONFIG
+            )
+    except ClientError as error:
         logger.info("Creating a temporary S3 privileged user failed with the following error : {}".format(error))
+        if not is_throttling_error(error):
+            raise
+        return None
+    return json_to_dict(fetcher)
 
 def assume_role():
     """
-    Return a boto client.
-    :return boto3.client('sts'): Create and return an STS boto client
+    Return a boto client. The client is created once and reused on warm invocations.
+    :return _STS_CLIENT: An STS boto client
     """
-    try:
-        return boto3.client('sts')
-    except Exception as error:
-        logger.info("Creating a boto client failed with the following error : {}".format(error))
+    global _STS_CLIENT
+    with _CLIENT_LOCK:
+        if _STS_CLIENT is None:
+            _STS_CLIENT = _SESSION.create_client('sts', config=CLIENT_CONFIG)
+    return _STS_CLIENT
 
+def get_config():
+    """
+    Return the config, fetching it from S3 only when the cached copy is missing or older than CONFIG_CACHE_TTL seconds.
+    If the refetch fails, the stale cached copy is returned instead.
+    :return _CONFIG_CACHE['value']: The contents of the json file in a dictionary format, or None if nothing could be fetched yet
+    """
+    if _CONFIG_CACHE['value'] is None or time.time() - _CONFIG_CACHE['fetched_at'] >= CONFIG_CACHE_TTL:
+        config = fetch_config_from_s3(assume_role())
+        if config is not None:
+            _CONFIG_CACHE['value'] = config
+            _CONFIG_CACHE['fetched_at'] = time.time()
+        elif _CONFIG_CACHE['value'] is not None:
+            logger.info("Refetching the config failed, using the cached copy instead.")
+    return _CONFIG_CACHE['value']
+
+def process_account(client, role_arn, config, now, start_up_time, stop_time, tz):
+    """
+    Start or stop the instances of a single account.
+    :param client: A boto client to assume the role of the account.
+    :param role_arn: The arn of the role that will be assumed.
+    :param config: A disctionary with the configuration values.
+    :param now: The current time.
+    :param start_up_time: The time when the instances should be started.
+    :param stop_time: The time when the instances should be stopped.
+    :param tz: The current timezone
+    """
+    account_number = role_arn.split(":")[4]
+    ec2_user = create_temp_user(client, role_arn)
+    if ec2_user is None:
+        logger.info("Skipping account {} because its role could not be assumed".format(account_number))
+        return
+
+    logger.info("Lambda started for account : {}".format(config['account_names'][account_number]))
+    start_stop(now, start_up_time, stop_time, ec2_user, config, tz)
 
 def lambda_handler(event, context):
     """
     Trigger function for lambda
     """
     try:
-        day = datetime.datetime.now().weekday()
-
-        fetcher = assume_role()
-        config = fetch_config_from_s3(fetcher)
-        print config
-
-        if is_weekday(day, config['schedule']['halfDay']):
-            client = assume_role()
-            for role_arn in config['role_arns']:
-                account_number = role_arn.split(":")[4]
-                ec2_user = create_temp_user(client, role_arn)
-
-                start_up_time, stop_time, now, tz = convert_to_datetime(config['times'])
-                logger.info("Lambda started for account : {}".format(config['account_names'][account_number]))
-                start_stop(now, start_up_time, stop_time, ec2_user, config, tz)
-        else:
+        now = datetime.datetime.now(TIMEZONE)
+        day = now.weekday()
+
+        config = get_config()
+        if config is None:
+            logger.info("No config could be fetched, nothing will be started or stopped.")
+            return
+        logger.info(config)
+
+        if not is_weekday(day, config['schedule']['halfDay']):
             logger.info("I do not operate on weekends.")
+            return
+
+        start_up_time, stop_time, tz = convert_to_datetime(config['times'], now)
+        if not has_action(now, start_up_time, stop_time):
+            logger.info("Nothing to start or stop at {}, {}".format(now.strftime("%H:%M"), tz))
+            return
+
+        client = assume_role()
+        role_arns = config['role_arns']
+        failed_role_arns = []
+        if role_arns:
+            with ThreadPoolExecutor(max_workers=min(MAX_ACCOUNT_WORKERS, len(role_arns))) as executor:
+                futures = {
+                    executor.submit(process_account, client, role_arn, config, now, start_up_time, stop_time, tz): role_arn
+                    for role_arn in role_arns
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as error:
+                        logger.error("Processing role {} failed with the following error : {}".format(futures[future], error))
+                        failed_role_arns.append(futures[future])
+        if failed_role_arns:
+            # Raised only once every account has been processed, so Lambda's retry policy sees the failure.
+            raise RuntimeError("Processing failed for the following roles : {}".format(', '.join(failed_role_arns)))
     except Exception as error:
         logger.info("Lambda failed to run with the following error : {}".format(error))
+        raise
 